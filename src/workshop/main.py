@@ -1,7 +1,15 @@
+import argparse
 import asyncio
 from datetime import date
+import json
 import logging
 import os
+import random
+import re
+import sys
+import time
+import traceback
+from pathlib import Path
 
 from azure.ai.projects import AIProjectClient
 from azure.ai.agents import AgentsClient
@@ -25,50 +33,77 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Workshop files live under src/workshop/ when running from the repo root in the dev container
+WORKSHOP_PATH_PREFIX = "src/workshop/" if os.getenv("ENVIRONMENT", "local") == "container" else ""
+DOWNLOADS_DIR = f"{WORKSHOP_PATH_PREFIX}files"
+
 TENTS_DATA_SHEET_FILE = "datasheet/contoso-tents-datasheet.pdf"
 API_DEPLOYMENT_NAME = os.getenv("AGENT_MODEL_DEPLOYMENT_NAME")
 PROJECT_ENDPOINT = os.environ["PROJECT_ENDPOINT"]
-AZURE_SUBSCRIPTION_ID = os.environ["AZURE_SUBSCRIPTION_ID"]
-AZURE_RESOURCE_GROUP_NAME = os.environ["AZURE_RESOURCE_GROUP_NAME"]
-AZURE_PROJECT_NAME = os.environ["AZURE_PROJECT_NAME"]
+# Only needed when PROJECT_ENDPOINT is a base endpoint without /api/projects/
+AZURE_SUBSCRIPTION_ID = os.getenv("AZURE_SUBSCRIPTION_ID")
+AZURE_RESOURCE_GROUP_NAME = os.getenv("AZURE_RESOURCE_GROUP_NAME")
+AZURE_PROJECT_NAME = os.getenv("AZURE_PROJECT_NAME")
 BING_CONNECTION_NAME = os.getenv("BING_CONNECTION_NAME")
 MAX_COMPLETION_TOKENS = 4096
 MAX_PROMPT_TOKENS = 10240
 TEMPERATURE = 0.1
 TOP_P = 0.1
+ACTIVE_RUN_STATUSES = frozenset({"queued", "in_progress", "requires_action"})
+RUN_POLL_INITIAL_INTERVAL = 0.2  # seconds
+RUN_POLL_MAX_INTERVAL = 4.0  # seconds
+RUN_POLL_BACKOFF_FACTOR = 1.5
+RUN_TIMEOUT_SECONDS = 240
+INSTRUCTIONS_PLACEHOLDER_RE = re.compile(r"\{(database_schema_string|current_date)\}")
 
 toolset = AsyncToolSet()
 sales_data = SalesData()
 utilities = Utilities()
 
 # Project client initialization (outside the context manager for global access)
-# Try different client initialization approaches
-try:
+# A single credential is shared by whichever client configuration is used
+credential = DefaultAzureCredential()
+
+if "/api/projects/" in PROJECT_ENDPOINT:
     # Method 1: Full endpoint approach
-    if "/api/projects/" in PROJECT_ENDPOINT:
-        project_client = AIProjectClient(
-            endpoint=PROJECT_ENDPOINT,
-            credential=DefaultAzureCredential(),
+    project_client = AIProjectClient(
+        endpoint=PROJECT_ENDPOINT,
+        credential=credential,
+    )
+    print(f"Using full project endpoint: {PROJECT_ENDPOINT}")
+else:
+    missing = [
+        name
+        for name, value in (
+            ("AZURE_SUBSCRIPTION_ID", AZURE_SUBSCRIPTION_ID),
+            ("AZURE_RESOURCE_GROUP_NAME", AZURE_RESOURCE_GROUP_NAME),
+            ("AZURE_PROJECT_NAME", AZURE_PROJECT_NAME),
+        )
+        if not value
+    ]
+    if missing:
+        raise RuntimeError(
+            f"PROJECT_ENDPOINT is a base endpoint, so these environment variables must be set: {', '.join(missing)}"
         )
-        print(f"Using full project endpoint: {PROJECT_ENDPOINT}")
-    else:
+
+    try:
         # Method 2: Base endpoint approach
         project_client = AIProjectClient(
             endpoint=PROJECT_ENDPOINT,
-            credential=DefaultAzureCredential(),
+            credential=credential,
             subscription_id=AZURE_SUBSCRIPTION_ID,
             resource_group_name=AZURE_RESOURCE_GROUP_NAME,
             project_name=AZURE_PROJECT_NAME,
         )
         print(f"Using base endpoint with project details: {PROJECT_ENDPOINT}")
-except Exception as e:
-    print(f"Error creating project client: {e}")
-    # Fallback: try with just endpoint
-    project_client = AIProjectClient(
-        endpoint=PROJECT_ENDPOINT,
-        credential=DefaultAzureCredential(),
-    )
-    print("Using fallback client configuration")
+    except Exception as e:
+        print(f"Error creating project client: {e}")
+        # Fallback: try with just endpoint
+        project_client = AIProjectClient(
+            endpoint=PROJECT_ENDPOINT,
+            credential=credential,
+        )
+        print("Using fallback client configuration")
 
 functions = AsyncFunctionTool(
     {
@@ -76,11 +111,24 @@ functions = AsyncFunctionTool(
     }
 )
 
+# Pick the instructions with INSTRUCTIONS_FILE in .env, or uncomment one of the lab lines below
+INSTRUCTIONS_FILE = os.getenv("INSTRUCTIONS_FILE")
 # INSTRUCTIONS_FILE = "instructions/instructions_function_calling.txt"
 # INSTRUCTIONS_FILE = "instructions/instructions_code_interpreter.txt"
 # INSTRUCTIONS_FILE = "instructions/instructions_file_search.txt"
 
 
+def retry_delay(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    """Return an exponential backoff delay, with jitter, for the given retry attempt."""
+    return min(cap, base * (2**attempt)) + random.uniform(0, 0.25)
+
+
+async def run_sales_data_tool_call(arguments: str) -> str:
+    """Parse a tool call's JSON arguments and run the sales data query."""
+    args = json.loads(arguments)
+    return await sales_data.async_fetch_sales_data_using_sqlite_query(args["sqlite_query"])
+
+
 async def add_agent_tools():
     """Add tools for the agent."""
 
@@ -116,15 +164,20 @@ async def initialize() -> tuple[Agent, AgentThread]:
     database_schema_string = await sales_data.get_database_info()
 
     try:
-        env = os.getenv("ENVIRONMENT", "local")
-        INSTRUCTIONS_FILE_PATH = f"{'src/workshop/' if env == 'container' else ''}{INSTRUCTIONS_FILE}"
+        if not INSTRUCTIONS_FILE:
+            raise ValueError("No instructions file selected.")
+        INSTRUCTIONS_FILE_PATH = f"{WORKSHOP_PATH_PREFIX}{INSTRUCTIONS_FILE}"
         
-        with open(INSTRUCTIONS_FILE_PATH, "r", encoding="utf-8", errors="ignore") as file:
-            instructions = file.read()
+        # Unbuffered read: FileIO.readall sizes its buffer from the file's stat, then decode once
+        with open(INSTRUCTIONS_FILE_PATH, "rb", buffering=0) as file:
+            instructions = file.read().decode("utf-8", errors="ignore")
 
-        # Replace the placeholder with the database schema string
-        instructions = instructions.replace("{database_schema_string}", database_schema_string)
-        instructions = instructions.replace("{current_date}", date.today().strftime("%Y-%m-%d"))
+        # Fill the schema and date placeholders in a single pass over the template
+        placeholders = {
+            "database_schema_string": database_schema_string,
+            "current_date": date.today().isoformat(),
+        }
+        instructions = INSTRUCTIONS_PLACEHOLDER_RE.sub(lambda match: placeholders[match.group(1)], instructions)
 
         # Add agent tools (this must be done inside the context manager)
         await add_agent_tools()
@@ -168,75 +221,100 @@ async def cleanup(agent: Agent, thread: AgentThread) -> None:
 async def post_message(thread_id: str, content: str, agent: Agent, thread: AgentThread) -> None:
     """Post a message to the Azure AI Agent Service."""
     try:
-        print(f"Creating message in thread {thread_id}...")
+        logger.debug("Creating message in thread %s...", thread_id)
         
         # Create message using project_client directly
-        message = project_client.agents.messages.create(
+        # The sync SDK calls run in a worker thread so they don't block the event loop
+        message = await asyncio.to_thread(
+            project_client.agents.messages.create,
             thread_id=thread_id,
             role="user",
             content=content,
         )
-        print(f"Message created: {message.id}")
+        logger.debug("Message created: %s", message.id)
 
-        print(f"Creating run for agent {agent.id}...")
+        logger.debug("Creating run for agent %s...", agent.id)
         # Create and poll run
-        run = project_client.agents.runs.create(
+        run = await asyncio.to_thread(
+            project_client.agents.runs.create,
             thread_id=thread.id,
             agent_id=agent.id,
         )
-        print(f"Run created: {run.id}")
+        logger.debug("Run created: %s", run.id)
         
         # Enhanced polling with action handling
-        import time
-        max_iterations = 120  # Max 2 minutes
+        # Poll quickly at first so short runs return fast, then back off up to a cap
+        started = time.monotonic()
         iteration = 0
+        backoff_step = 0
+        status_errors = 0
+        timed_out = False
         
-        while run.status in ("queued", "in_progress", "requires_action") and iteration < max_iterations:
-            time.sleep(2)  # Increased sleep time
+        while run.status in ACTIVE_RUN_STATUSES:
+            if time.monotonic() - started > RUN_TIMEOUT_SECONDS:
+                timed_out = True
+                break
+            await asyncio.sleep(
+                min(RUN_POLL_MAX_INTERVAL, RUN_POLL_INITIAL_INTERVAL * RUN_POLL_BACKOFF_FACTOR**backoff_step)
+            )
             iteration += 1
+            backoff_step += 1
+            previous_status = run.status
             
             try:
-                run = project_client.agents.runs.get(thread_id=thread.id, run_id=run.id)
-                print(f"Run status: {run.status} (iteration {iteration})")
+                run = await asyncio.to_thread(project_client.agents.runs.get, thread_id=thread.id, run_id=run.id)
+                logger.debug("Run status: %s (iteration %d)", run.status, iteration)
             except Exception as e:
                 print(f"Error getting run status: {e}")
-                time.sleep(5)  # Wait longer on error
+                # Exponential backoff with jitter on status errors
+                await asyncio.sleep(retry_delay(status_errors))
+                status_errors += 1
                 continue
+            status_errors = 0
+            # The run moved on (e.g. queued -> in_progress), so poll quickly again for the next change
+            if run.status != previous_status:
+                backoff_step = 0
             
             # Handle required actions (function calls)
             if run.status == "requires_action" and run.required_action:
-                print("Run requires action - handling function calls...")
+                logger.debug("Run requires action - handling function calls...")
                 
                 tool_outputs = []
                 try:
+                    # Argument parsing happens inside each call, so a bad call only fails its own output
+                    pending_calls = []
                     for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                        print(f"Executing function: {tool_call.function.name}")
+                        logger.debug("Executing function: %s", tool_call.function.name)
                         
-                        # Execute the function call
                         if tool_call.function.name == "async_fetch_sales_data_using_sqlite_query":
-                            import json
-                            args = json.loads(tool_call.function.arguments)
-                            result = await sales_data.async_fetch_sales_data_using_sqlite_query(args["sqlite_query"])
-                            tool_outputs.append({
-                                "tool_call_id": tool_call.id,
-                                "output": result
-                            })
+                            pending_calls.append((tool_call.id, run_sales_data_tool_call(tool_call.function.arguments)))
+
+                    # Execute the function calls; queries share one aiosqlite connection, which runs them in turn
+                    results = await asyncio.gather(*(call for _, call in pending_calls), return_exceptions=True)
+                    for (tool_call_id, _), result in zip(pending_calls, results):
+                        if isinstance(result, Exception):
+                            result = json.dumps({"Function call failed with error": str(result)})
+                        tool_outputs.append({
+                            "tool_call_id": tool_call_id,
+                            "output": result
+                        })
                     
                     # Submit the tool outputs
                     if tool_outputs:
-                        print("Submitting tool outputs...")
-                        run = project_client.agents.runs.submit_tool_outputs(
+                        logger.debug("Submitting tool outputs...")
+                        run = await asyncio.to_thread(
+                            project_client.agents.runs.submit_tool_outputs,
                             thread_id=thread.id,
                             run_id=run.id,
                             tool_outputs=tool_outputs
                         )
-                        print("Tool outputs submitted successfully")
+                        logger.debug("Tool outputs submitted successfully")
                 except Exception as e:
                     print(f"Error handling tool outputs: {e}")
                     break
         
-        if iteration >= max_iterations:
-            print("Run timed out after maximum iterations")
+        if timed_out:
+            print(f"Run timed out after {RUN_TIMEOUT_SECONDS} seconds")
             return
             
         print(f"Run finished with status: {run.status}")
@@ -246,19 +324,23 @@ async def post_message(thread_id: str, content: str, agent: Agent, thread: Agent
         elif run.status == "completed":
             # Get the last message from the agent
             try:
-                response = project_client.agents.messages.get_last_message_by_role(
+                response = await asyncio.to_thread(
+                    project_client.agents.messages.get_last_message_by_role,
                     thread_id=thread_id,
                     role=MessageRole.AGENT,
                 )
                 if response:
                     print("\nAgent response:")
-                    print("\n".join(t.text.value for t in response.text_messages))
+                    for text_message in response.text_messages:
+                        sys.stdout.write(text_message.text.value)
+                        sys.stdout.write("\n")
+                    sys.stdout.flush()
                 else:
                     print("No response message found")
                 
                 # Handle file downloads from code interpreter
                 try:
-                    utilities.download_agent_files(project_client, thread_id)
+                    await asyncio.to_thread(utilities.download_agent_files, project_client, thread_id, DOWNLOADS_DIR)
                 except Exception as e:
                     print(f"Error handling file downloads: {e}")
                     
@@ -267,7 +349,6 @@ async def post_message(thread_id: str, content: str, agent: Agent, thread: Agent
 
     except Exception as e:
         print(f"An error occurred posting the message: {str(e)}")
-        import traceback
         traceback.print_exc()
 
 
@@ -278,6 +359,7 @@ async def main() -> None:
     """
     # Use the project client within a context manager for the entire session
     with project_client:
+        Path(DOWNLOADS_DIR).mkdir(parents=True, exist_ok=True)
         agent, thread = await initialize()
 
         while True:
@@ -294,6 +376,11 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Contoso Sales AI Agent workshop")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show run progress and polling details")
+    if parser.parse_args().verbose:
+        logger.setLevel(logging.DEBUG)
+
     print("Starting async program...")
     asyncio.run(main())
     print("Program finished.")
@@ -4,7 +4,6 @@ import os
 from typing import Optional, Coroutine
 
 import aiosqlite
-import pandas as pd
 
 from terminal_colors import TerminalColors as tc
 
@@ -119,10 +118,10 @@ class SalesData:
                 rows = await cursor.fetchall()
                 columns = [description[0] for description in cursor.description]
 
-            if not rows:  # No need to create DataFrame if there are no rows
+            if not rows:
                 return json.dumps("The query returned no results. Try a different question.")
-            data = pd.DataFrame(rows, columns=columns)
-            return data.to_json(index=False, orient="split")
+            # Same "split" layout as DataFrame.to_json(orient="split", index=False), without building a DataFrame
+            return json.dumps({"columns": columns, "data": rows}, separators=(",", ":"))
 
         except Exception as e:
             return json.dumps({"SQLite query failed with error": str(e), "query": sqlite_query})
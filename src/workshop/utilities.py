@@ -66,14 +66,11 @@ class Utilities:
         try:
             messages = project_client.agents.messages.list(thread_id=thread_id)
             
-            # Create downloads directory if it doesn't exist
-            import os
+            # Callers that pass downloads_dir create it once up front; only the default needs creating here
             if downloads_dir is None:
                 env = os.getenv("ENVIRONMENT", "local")
                 downloads_dir = f"{'src/workshop/' if env == 'container' else ''}files"
-            
-            if not os.path.exists(downloads_dir):
-                os.makedirs(downloads_dir)
+                os.makedirs(downloads_dir, exist_ok=True)
             
             # Get the latest agent message only (to avoid redownloading old files)
             latest_agent_message = None